@@ -1,708 +1,1245 @@
-import os
-import sqlite3
-from datetime import datetime, timedelta, date
-from functools import wraps
-
-from flask import (
-    Flask, g, redirect, render_template, request, session,
-    url_for, flash, jsonify
-)
-from authlib.integrations.flask_client import OAuth
-
-# =========================
-# Config
-# =========================
-APP_SECRET = os.environ.get("APP_SECRET", "crm_mimovil_clave_larga_cambiar")
-DATABASE = os.environ.get("DATABASE_PATH", "crm.sqlite")
-
-GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
-GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
-
-ALLOWED_EMAILS = set(
-    e.strip().lower()
-    for e in os.environ.get("ALLOWED_EMAILS", "").split(",")
-    if e.strip()
-)
-
-ALERT_DAYS = int(os.environ.get("ALERT_DAYS", "30"))
-
-app = Flask(__name__)
-app.secret_key = APP_SECRET
-
-app.config.update(
-    SESSION_COOKIE_HTTPONLY=True,
-    SESSION_COOKIE_SAMESITE="Lax",
-)
-
-# =========================
-# OAuth Google
-# =========================
-oauth = OAuth(app)
-
-google = oauth.register(
-    name="google",
-    client_id=GOOGLE_CLIENT_ID,
-    client_secret=GOOGLE_CLIENT_SECRET,
-    access_token_url="https://oauth2.googleapis.com/token",
-    authorize_url="https://accounts.google.com/o/oauth2/v2/auth",
-    api_base_url="https://www.googleapis.com/oauth2/v2/",
-    client_kwargs={"scope": "email profile"},
-)
-
-# =========================
-# DB helpers
-# =========================
-def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA foreign_keys = ON;")
-    return g.db
-
-
-@app.teardown_appcontext
-def close_db(exception=None):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
-
-
-def _col_exists(db, table: str, col: str) -> bool:
-    rows = db.execute(f"PRAGMA table_info({table})").fetchall()
-    return any(r["name"] == col for r in rows)
-
-
-def _add_col_if_missing(db, table: str, col: str, coltype: str):
-    if not _col_exists(db, table, col):
-        db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype};")
-
-
-def init_db():
-    db = get_db()
-
-    # ---- Clients ----
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS clients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_name TEXT NOT NULL,
-            dni TEXT NOT NULL,
-            birth_date TEXT,
-            phone TEXT,
-            address TEXT,
-            email TEXT,
-            current_operator TEXT,
-            current_tariff_price TEXT,
-            permanence TEXT,
-            terminal TEXT,
-            sales_done TEXT,
-            repairs_done TEXT,
-            procedures_done TEXT,
-            observations TEXT,
-            pending_tasks TEXT,
-            created_at TEXT NOT NULL
-        );
-    """)
-
-    # Compat columnas viejas
-    _add_col_if_missing(db, "clients", "permanence_start", "TEXT")
-    _add_col_if_missing(db, "clients", "permanence_end", "TEXT")
-
-    # Columnas nuevas permanencia
-    _add_col_if_missing(db, "clients", "permanence_start_date", "TEXT")
-    _add_col_if_missing(db, "clients", "permanence_months", "INTEGER")
-    _add_col_if_missing(db, "clients", "permanence_end_date", "TEXT")
-
-    # Nuevo: Comercial
-    _add_col_if_missing(db, "clients", "commercial", "TEXT")
-
-    # ---- Mobile lines ----
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS mobile_lines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id INTEGER NOT NULL,
-            line_number TEXT,
-            pin TEXT,
-            puk TEXT,
-            icc TEXT,
-            google_or_iphone_account TEXT,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
-        );
-    """)
-    # Nuevo: fin permanencia por línea
-    _add_col_if_missing(db, "mobile_lines", "permanence_end_date", "TEXT")
-
-    # ---- Repairs ----
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS repairs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id INTEGER NOT NULL,
-            date TEXT,
-            model TEXT,
-            repair TEXT,
-            cost REAL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
-        );
-    """)
-
-    # ---- Sales ----
-    db.execute("""
-        CREATE TABLE IF NOT EXISTS sales (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id INTEGER NOT NULL,
-            date TEXT,
-            item TEXT,
-            operator TEXT,
-            amount REAL,
-            notes TEXT,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
-        );
-    """)
-
-    # Backfill: sincronizar fin permanencia vieja/nueva
-    db.execute("""
-        UPDATE clients
-        SET permanence_end_date = permanence_end
-        WHERE (permanence_end_date IS NULL OR permanence_end_date = '')
-          AND permanence_end IS NOT NULL AND permanence_end != '';
-    """)
-
-    db.execute("""
-        UPDATE clients
-        SET permanence_end = permanence_end_date
-        WHERE (permanence_end IS NULL OR permanence_end = '')
-          AND permanence_end_date IS NOT NULL AND permanence_end_date != '';
-    """)
-
-    db.commit()
-
-
-with app.app_context():
-    init_db()
-
-# =========================
-# Date utils
-# =========================
-def parse_yyyy_mm_dd(s: str):
-    s = (s or "").strip()
-    if not s:
-        return None
-
-    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
-        try:
-            return datetime.strptime(s, fmt).date()
-        except ValueError:
-            pass
-    return None
-
-
-def add_months(d: date, months: int) -> date:
-    y = d.year + (d.month - 1 + months) // 12
-    m = (d.month - 1 + months) % 12 + 1
-    day = d.day
-
-    if m == 12:
-        next_month = date(y + 1, 1, 1)
-    else:
-        next_month = date(y, m + 1, 1)
-
-    last_day = (next_month - timedelta(days=1)).day
-    if day > last_day:
-        day = last_day
-    return date(y, m, day)
-
-
-def compute_permanence_end(start_str: str, months_str: str, end_str: str):
-    start = parse_yyyy_mm_dd(start_str)
-    end = parse_yyyy_mm_dd(end_str)
-
-    months_int = None
-    ms = (months_str or "").strip()
-    if ms:
-        try:
-            months_int = int(ms)
-        except ValueError:
-            months_int = None
-
-    if end is None and start is not None and months_int is not None:
-        end = add_months(start, months_int)
-
-    start_iso = start.isoformat() if start else None
-    end_iso = end.isoformat() if end else None
-    return start_iso, months_int, end_iso
-
-
-def get_end_date_from_client_row(c):
-    if not c:
-        return None
-
-    keys = c.keys()
-    end_iso = None
-
-    if "permanence_end_date" in keys:
-        end_iso = c["permanence_end_date"]
-
-    if (not end_iso) and ("permanence_end" in keys):
-        end_iso = c["permanence_end"]
-
-    return (end_iso or "").strip() or None
-
-
-def days_until(end_iso: str):
-    d = parse_yyyy_mm_dd(end_iso)
-    if not d:
-        return None
-    return (d - date.today()).days
-
-# =========================
-# Auth
-# =========================
-def login_required(view):
-    @wraps(view)
-    def wrapped(*args, **kwargs):
-        if not session.get("user"):
-            return redirect(url_for("login"))
-        return view(*args, **kwargs)
-    return wrapped
-
-
-def is_allowed(email):
-    if not ALLOWED_EMAILS:
-        return True
-    return (email or "").lower() in ALLOWED_EMAILS
-
-# =========================
-# Routes
-# =========================
-@app.route("/")
-def home():
-    if session.get("user"):
-        return redirect(url_for("clients"))
-    return redirect(url_for("login"))
-
-
-@app.route("/login")
-def login():
-    return render_template("login.html")
-
-
-@app.route("/auth/google")
-def auth_google():
-    remember = request.args.get("remember") == "1"
-    session["remember_me"] = remember
-    redirect_uri = url_for("auth_google_callback", _external=True)
-    return google.authorize_redirect(redirect_uri)
-
-
-@app.route("/auth/google/callback")
-def auth_google_callback():
-    google.authorize_access_token()
-    userinfo = google.get("userinfo").json()
-
-    email = userinfo.get("email")
-    if not is_allowed(email):
-        session.clear()
-        flash("Cuenta no autorizada", "danger")
-        return redirect(url_for("login"))
-
-    session["user"] = {"email": email, "name": userinfo.get("name") or email}
-
-    if session.get("remember_me"):
-        session.permanent = True
-        app.permanent_session_lifetime = timedelta(days=30)
-
-    session.pop("remember_me", None)
-    return redirect(url_for("clients"))
-
-
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
-
-
-@app.route("/clients")
-@login_required
-def clients():
-    db = get_db()
-    q = request.args.get("q", "").strip()
-
-    if q:
-        rows = db.execute(
-            """
-            SELECT * FROM clients
-            WHERE full_name LIKE ? OR dni LIKE ? OR phone LIKE ?
-            ORDER BY id DESC
-            """,
-            (f"%{q}%", f"%{q}%", f"%{q}%")
-        ).fetchall()
-    else:
-        rows = db.execute("SELECT * FROM clients ORDER BY id DESC").fetchall()
-
-    days_left_map = {}
-    for c in rows:
-        end_iso = get_end_date_from_client_row(c)
-        days_left_map[c["id"]] = days_until(end_iso) if end_iso else None
-
-    return render_template(
-        "clients_list.html",
-        clients=rows,
-        q=q,
-        alert_days=ALERT_DAYS,
-        days_left_map=days_left_map
-    )
-
-
-@app.route("/calendar", endpoint="calendar_view")
-@login_required
-def calendar_view():
-    days = request.args.get("days", "365").strip()
-    try:
-        days_int = int(days)
-    except ValueError:
-        days_int = 365
-
-    today = date.today()
-    limit = today + timedelta(days=days_int)
-
-    db = get_db()
-    rows = db.execute("SELECT * FROM clients ORDER BY id DESC").fetchall()
-
-    upcoming = []
-    for r in rows:
-        end_iso = get_end_date_from_client_row(r)
-        if not end_iso:
-            continue
-        end_d = parse_yyyy_mm_dd(end_iso)
-        if not end_d:
-            continue
-        if today <= end_d <= limit:
-            upcoming.append((r, (end_d - today).days))
-
-    upcoming.sort(key=lambda t: parse_yyyy_mm_dd(get_end_date_from_client_row(t[0])) or date.max)
-
-    return render_template("calendar.html", upcoming=upcoming, days=days_int, alert_days=ALERT_DAYS)
-
-
-@app.route("/api/permanencias", endpoint="api_permanencias")
-@login_required
-def api_permanencias():
-    db = get_db()
-    rows = db.execute("SELECT * FROM clients ORDER BY id DESC").fetchall()
-
-    out = []
-    for r in rows:
-        end_iso = get_end_date_from_client_row(r)
-        if not end_iso:
-            continue
-
-        out.append({
-            "id": r["id"],
-            "full_name": r["full_name"],
-            "phone": r["phone"],
-            "email": r["email"],
-            "current_operator": r["current_operator"],
-            "permanence_end_date": end_iso,
-            "days_left": days_until(end_iso),
-            "url": url_for("view_client", client_id=r["id"])
-        })
-
-    out.sort(key=lambda x: x["permanence_end_date"] or "9999-12-31")
-    return jsonify(out)
-
-
-@app.route("/clients/new", methods=["GET", "POST"])
-@login_required
-def new_client():
-    if request.method == "POST":
-        db = get_db()
-
-        p_start, p_months, p_end = compute_permanence_end(
-            request.form.get("permanence_start_date") or request.form.get("permanence_start"),
-            request.form.get("permanence_months"),
-            request.form.get("permanence_end_date") or request.form.get("permanence_end"),
-        )
-
-        cur = db.execute("""
-            INSERT INTO clients (
-                full_name, dni, birth_date, phone, address, email,
-                current_operator, current_tariff_price,
-                permanence,
-                permanence_start, permanence_end,
-                permanence_start_date, permanence_months, permanence_end_date,
-                terminal, sales_done, repairs_done, procedures_done, observations,
-                pending_tasks, commercial, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            request.form["full_name"],
-            request.form["dni"],
-            request.form.get("birth_date"),
-            request.form.get("phone"),
-            request.form.get("address"),
-            request.form.get("email"),
-            request.form.get("current_operator"),
-            request.form.get("current_tariff_price"),
-            request.form.get("permanence"),
-            p_start, p_end,
-            p_start, p_months, p_end,
-            request.form.get("terminal"),
-            request.form.get("sales_done"),
-            request.form.get("repairs_done"),
-            request.form.get("procedures_done"),
-            request.form.get("observations"),
-            request.form.get("pending_tasks"),
-            request.form.get("commercial"),
-            datetime.utcnow().isoformat()
-        ))
-        client_id = cur.lastrowid
-        db.commit()
-        return redirect(url_for("view_client", client_id=client_id))
-
-    return render_template("client_form.html", client=None, lines=[], repairs=[], sales=[], alert_days=ALERT_DAYS)
-
-
-@app.route("/clients/<int:client_id>")
-@login_required
-def view_client(client_id):
-    db = get_db()
-
-    client = db.execute("SELECT * FROM clients WHERE id = ?", (client_id,)).fetchone()
-    if client is None:
-        flash("Cliente no encontrado", "danger")
-        return redirect(url_for("clients"))
-
-    lines = db.execute(
-        "SELECT * FROM mobile_lines WHERE client_id = ? ORDER BY id DESC",
-        (client_id,)
-    ).fetchall()
-
-    repairs = db.execute(
-        "SELECT * FROM repairs WHERE client_id = ? ORDER BY id DESC",
-        (client_id,)
-    ).fetchall()
-
-    sales = db.execute(
-        "SELECT * FROM sales WHERE client_id = ? ORDER BY id DESC",
-        (client_id,)
-    ).fetchall()
-
-    end_iso = get_end_date_from_client_row(client)
-    du = days_until(end_iso) if end_iso else None
-
-    return render_template(
-        "client_form.html",
-        client=client,
-        lines=lines,
-        repairs=repairs,
-        sales=sales,
-        alert_days=ALERT_DAYS,
-        days_left=du
-    )
-
-
-@app.route("/clients/<int:client_id>/update", methods=["POST"])
-@login_required
-def update_client(client_id):
-    db = get_db()
-
-    p_start, p_months, p_end = compute_permanence_end(
-        request.form.get("permanence_start_date") or request.form.get("permanence_start"),
-        request.form.get("permanence_months"),
-        request.form.get("permanence_end_date") or request.form.get("permanence_end"),
-    )
-
-    db.execute("""
-        UPDATE clients SET
-            full_name = ?,
-            dni = ?,
-            birth_date = ?,
-            phone = ?,
-            address = ?,
-            email = ?,
-            current_operator = ?,
-            current_tariff_price = ?,
-            permanence = ?,
-
-            permanence_start = ?,
-            permanence_end = ?,
-
-            permanence_start_date = ?,
-            permanence_months = ?,
-            permanence_end_date = ?,
-
-            terminal = ?,
-            sales_done = ?,
-            repairs_done = ?,
-            procedures_done = ?,
-            observations = ?,
-            pending_tasks = ?,
-            commercial = ?
-        WHERE id = ?
-    """, (
-        request.form["full_name"],
-        request.form["dni"],
-        request.form.get("birth_date"),
-        request.form.get("phone"),
-        request.form.get("address"),
-        request.form.get("email"),
-        request.form.get("current_operator"),
-        request.form.get("current_tariff_price"),
-        request.form.get("permanence"),
-
-        p_start,
-        p_end,
-
-        p_start,
-        p_months,
-        p_end,
-
-        request.form.get("terminal"),
-        request.form.get("sales_done"),
-        request.form.get("repairs_done"),
-        request.form.get("procedures_done"),
-        request.form.get("observations"),
-        request.form.get("pending_tasks"),
-        request.form.get("commercial"),
-        client_id
-    ))
-
-    # -------------------------
-    # Guardar líneas móviles
-    # -------------------------
-    db.execute("DELETE FROM mobile_lines WHERE client_id = ?", (client_id,))
-
-    line_count = int(request.form.get("line_count", "0") or "0")
-    for i in range(line_count):
-        line_number = (request.form.get(f"line_number_{i}") or "").strip()
-        pin = (request.form.get(f"pin_{i}") or "").strip()
-        puk = (request.form.get(f"puk_{i}") or "").strip()
-        icc = (request.form.get(f"icc_{i}") or "").strip()
-        account = (request.form.get(f"account_{i}") or "").strip()
-
-        # Nuevo: fin permanencia por línea
-        line_perm_end = (request.form.get(f"line_perm_end_{i}") or "").strip()
-
-        # Si no hay nada, saltamos
-        if not (line_number or pin or puk or icc or account or line_perm_end):
-            continue
-
-        db.execute("""
-            INSERT INTO mobile_lines (
-                client_id, line_number, pin, puk, icc,
-                google_or_iphone_account, permanence_end_date, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            client_id,
-            line_number,
-            pin,
-            puk,
-            icc,
-            account,
-            line_perm_end,
-            datetime.utcnow().isoformat()
-        ))
-
-    db.commit()
-    flash("Cliente actualizado", "success")
-    return redirect(url_for("view_client", client_id=client_id))
-
-
-@app.route("/clients/<int:client_id>/repairs/add", methods=["POST"])
-@login_required
-def add_repair(client_id):
-    db = get_db()
-
-    date_ = request.form.get("repair_date")
-    model = request.form.get("repair_model")
-    repair = request.form.get("repair_text")
-
-    cost_raw = (request.form.get("repair_cost") or "").strip()
-    cost = None
-    if cost_raw:
-        try:
-            cost = float(cost_raw.replace(",", "."))
-        except ValueError:
-            cost = None
-
-    db.execute("""
-        INSERT INTO repairs (client_id, date, model, repair, cost, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        client_id,
-        date_,
-        model,
-        repair,
-        cost,
-        datetime.utcnow().isoformat()
-    ))
-    db.commit()
-    return redirect(url_for("view_client", client_id=client_id))
-
-
-@app.route("/clients/<int:client_id>/repairs/<int:repair_id>/delete", methods=["POST"])
-@login_required
-def delete_repair(client_id, repair_id):
-    db = get_db()
-    db.execute("DELETE FROM repairs WHERE id = ? AND client_id = ?", (repair_id, client_id))
-    db.commit()
-    return redirect(url_for("view_client", client_id=client_id))
-
-
-@app.route("/clients/<int:client_id>/sales/add", methods=["POST"])
-@login_required
-def add_sale(client_id):
-    db = get_db()
-
-    date_ = request.form.get("sale_date")
-    item = request.form.get("sale_item")
-    operator = request.form.get("sale_operator")
-
-    amount_raw = (request.form.get("sale_amount") or "").strip()
-    amount = None
-    if amount_raw:
-        try:
-            amount = float(amount_raw.replace(",", "."))
-        except ValueError:
-            amount = None
-
-    notes = request.form.get("sale_notes")
-
-    db.execute("""
-        INSERT INTO sales (client_id, date, item, operator, amount, notes, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (
-        client_id,
-        date_,
-        item,
-        operator,
-        amount,
-        notes,
-        datetime.utcnow().isoformat()
-    ))
-    db.commit()
-    return redirect(url_for("view_client", client_id=client_id))
-
-
-@app.route("/clients/<int:client_id>/sales/<int:sale_id>/delete", methods=["POST"])
-@login_required
-def delete_sale(client_id, sale_id):
-    db = get_db()
-    db.execute("DELETE FROM sales WHERE id = ? AND client_id = ?", (sale_id, client_id))
-    db.commit()
-    return redirect(url_for("view_client", client_id=client_id))
-
-
-@app.route("/clients/<int:client_id>/delete", methods=["POST"])
-@login_required
-def delete_client(client_id):
-    db = get_db()
-    db.execute("DELETE FROM clients WHERE id = ?", (client_id,))
-    db.commit()
-    flash("Cliente eliminado", "success")
-    return redirect(url_for("clients"))
-
-
-if __name__ == "__main__":
-    app.run(debug=True)
+import json
+import os
+import re
+import threading
+
+# pysqlite3-binary trae un SQLite más nuevo (mejor planner, JSON1/FTS5
+# garantizados) con la misma API; si no está instalado, el de la stdlib
+try:
+    import pysqlite3 as sqlite3
+except ImportError:
+    import sqlite3
+from datetime import datetime, timedelta, date
+from functools import lru_cache, wraps
+
+from flask import (
+    Flask, Response, redirect, render_template, request, session,
+    url_for, flash, jsonify
+)
+from authlib.integrations.flask_client import OAuth
+
+# Serializador JSON en C (opcional): 3-10x más rápido que el de la stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# =========================
+# Config
+# =========================
+APP_SECRET = os.environ.get("APP_SECRET", "crm_mimovil_clave_larga_cambiar")
+DATABASE = os.environ.get("DATABASE_PATH", "crm.sqlite")
+
+GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID")
+GOOGLE_CLIENT_SECRET = os.environ.get("GOOGLE_CLIENT_SECRET")
+
+ALLOWED_EMAILS = frozenset(
+    e.strip().casefold()
+    for e in os.environ.get("ALLOWED_EMAILS", "").split(",")
+    if e.strip()
+)
+
+ALERT_DAYS = int(os.environ.get("ALERT_DAYS", "30"))
+
+app = Flask(__name__)
+app.secret_key = APP_SECRET
+
+app.config.update(
+    SESSION_COOKIE_HTTPONLY=True,
+    SESSION_COOKIE_SAMESITE="Lax",
+)
+
+# Sesión server-side en Redis (opcional, vía SESSION_REDIS_URL): en la cookie
+# viaja sólo el id de sesión, sin firmar/verificar el payload completo con
+# HMAC en cada petición
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL")
+if SESSION_REDIS_URL:
+    import redis
+    from flask_session import Session
+
+    app.config.update(
+        SESSION_TYPE="redis",
+        SESSION_REDIS=redis.Redis.from_url(SESSION_REDIS_URL, socket_keepalive=True),
+    )
+    Session(app)
+
+# Compresión de respuestas (opcional): el JSON de /api/permanencias repite
+# claves y comprime muy bien; si flask-compress no está instalado, sin cambios
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
+if Compress is not None:
+    app.config.update(
+        COMPRESS_MIMETYPES=[
+            "application/json", "text/html", "text/css", "application/javascript"
+        ],
+        COMPRESS_LEVEL=6,
+        COMPRESS_MIN_SIZE=500,
+    )
+    Compress(app)
+
+# Cache del listado de clientes ya renderizado (opcional): requiere Redis
+# (CACHE_REDIS_URL) además de flask-caching. Sin Redis queda desactivado:
+# una cache por proceso (SimpleCache) serviría listados viejos bajo
+# gunicorn -w N, porque el bump de versión sólo llegaría a un worker.
+try:
+    from flask_caching import Cache
+except ImportError:
+    Cache = None
+
+cache = None
+if Cache is not None:
+    _cache_redis_url = os.environ.get("CACHE_REDIS_URL")
+    if _cache_redis_url:
+        cache = Cache(app, config={
+            "CACHE_TYPE": "RedisCache",
+            "CACHE_REDIS_URL": _cache_redis_url,
+        })
+
+
+def _clients_cache_ver():
+    if cache is None:
+        return 0
+    return cache.get("clients:ver") or 0
+
+
+def _bump_clients_cache():
+    # Contador de versión en la clave: invalida todo el listado sin SCAN.
+    # INCR atómico del backend: con get+set dos escritores concurrentes
+    # podían leer la misma versión y perder una invalidación
+    if cache is not None:
+        cache.cache.inc("clients:ver")
+
+
+# =========================
+# OAuth Google
+# =========================
+oauth = OAuth(app)
+
+google = oauth.register(
+    name="google",
+    client_id=GOOGLE_CLIENT_ID,
+    client_secret=GOOGLE_CLIENT_SECRET,
+    access_token_url="https://oauth2.googleapis.com/token",
+    authorize_url="https://accounts.google.com/o/oauth2/v2/auth",
+    api_base_url="https://www.googleapis.com/oauth2/v2/",
+    client_kwargs={"scope": "email profile"},
+)
+
+# =========================
+# DB helpers
+# =========================
+# WAL es persistente en el fichero: basta activarlo una vez por proceso
+_wal_enabled = False
+
+# Una conexión por hilo (worker de gunicorn), reutilizada entre peticiones:
+# evita el coste de abrir/cerrar y mantiene caliente la page cache de SQLite
+_local = threading.local()
+
+
+def get_db():
+    global _wal_enabled
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # isolation_level=None: control explícito de transacciones (autocommit
+        # salvo BEGIN manual); cache de statements ampliada para el SQL largo
+        conn = sqlite3.connect(DATABASE, cached_statements=256, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not _wal_enabled:
+            conn.execute("PRAGMA journal_mode = WAL;")
+            _wal_enabled = True
+        # NORMAL (no OFF): bajo WAL ahorra un fsync por commit sin riesgo de corrupción
+        conn.executescript("""
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -20000;
+            PRAGMA mmap_size = 268435456;
+            PRAGMA foreign_keys = ON;
+        """)
+        _local.conn = conn
+    return conn
+
+
+# Columnas descubiertas por tabla: un solo PRAGMA table_info por tabla
+_cols_cache: dict = {}
+
+
+def _table_cols(db, table: str) -> set:
+    if table not in _cols_cache:
+        rows = db.execute(f"PRAGMA table_info({table})").fetchall()
+        _cols_cache[table] = {r["name"] for r in rows}
+    return _cols_cache[table]
+
+
+def _col_exists(db, table: str, col: str) -> bool:
+    return col in _table_cols(db, table)
+
+
+def _add_col_if_missing(db, table: str, col: str, coltype: str):
+    if not _col_exists(db, table, col):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {coltype};")
+        _cols_cache[table].add(col)
+
+
+# Garantiza que el esquema se reconcilia una sola vez por proceso,
+# aunque init_db() se llame de nuevo (p.ej. desde un hook por petición)
+_schema_ok = False
+
+
+def init_db():
+    global _schema_ok
+    if _schema_ok:
+        return
+
+    db = get_db()
+
+    # ---- Clients ----
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            full_name TEXT NOT NULL,
+            dni TEXT NOT NULL,
+            birth_date TEXT,
+            phone TEXT,
+            address TEXT,
+            email TEXT,
+            current_operator TEXT,
+            current_tariff_price TEXT,
+            permanence TEXT,
+            terminal TEXT,
+            sales_done TEXT,
+            repairs_done TEXT,
+            procedures_done TEXT,
+            observations TEXT,
+            pending_tasks TEXT,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+        );
+    """)
+
+    # Compat columnas viejas
+    _add_col_if_missing(db, "clients", "permanence_start", "TEXT")
+    _add_col_if_missing(db, "clients", "permanence_end", "TEXT")
+
+    # Columnas nuevas permanencia
+    _add_col_if_missing(db, "clients", "permanence_start_date", "TEXT")
+    _add_col_if_missing(db, "clients", "permanence_months", "INTEGER")
+    _add_col_if_missing(db, "clients", "permanence_end_date", "TEXT")
+
+    # Nuevo: Comercial
+    _add_col_if_missing(db, "clients", "commercial", "TEXT")
+
+    # ---- Mobile lines ----
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS mobile_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            line_number TEXT,
+            pin TEXT,
+            puk TEXT,
+            icc TEXT,
+            google_or_iphone_account TEXT,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
+        );
+    """)
+    # Nuevo: fin permanencia por línea
+    _add_col_if_missing(db, "mobile_lines", "permanence_end_date", "TEXT")
+
+    # ---- Repairs ----
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS repairs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            date TEXT,
+            model TEXT,
+            repair TEXT,
+            cost REAL,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
+        );
+    """)
+
+    # ---- Sales ----
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS sales (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id INTEGER NOT NULL,
+            date TEXT,
+            item TEXT,
+            operator TEXT,
+            amount REAL,
+            notes TEXT,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+            FOREIGN KEY (client_id) REFERENCES clients(id) ON DELETE CASCADE
+        );
+    """)
+
+    # ---- Índices para las consultas calientes ----
+    # Compuestos (client_id, id DESC): la consulta de hijos sale ordenada
+    # directamente del índice, sin paso de sort. El parcial sobre
+    # permanence_end_date cubre justo el filtro de /api/permanencias.
+    # Se retiran los índices de la iteración anterior que quedaron muertos
+    # (la búsqueda LIKE ya no existe: ahora es FTS5).
+    db.executescript("""
+        DROP INDEX IF EXISTS idx_clients_dni;
+        DROP INDEX IF EXISTS idx_clients_phone;
+        DROP INDEX IF EXISTS idx_clients_end;
+        DROP INDEX IF EXISTS idx_mobile_lines_client;
+        DROP INDEX IF EXISTS idx_repairs_client;
+        DROP INDEX IF EXISTS idx_sales_client;
+
+        CREATE INDEX IF NOT EXISTS idx_lines_client ON mobile_lines(client_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_repairs_client_id ON repairs(client_id, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_sales_client_id ON sales(client_id, id DESC);
+
+        CREATE INDEX IF NOT EXISTS idx_clients_perm_end ON clients(permanence_end_date)
+            WHERE permanence_end_date IS NOT NULL AND permanence_end_date != '';
+    """)
+
+    # Espejo automático entre la columna nueva y la vieja de fin de
+    # permanencia: lo mantienen triggers en C, sin escaneos de tabla.
+    # Los WHEN se anulan mutuamente, así que la cadena termina siempre.
+    db.executescript("""
+        CREATE TRIGGER IF NOT EXISTS tg_perm_end_sync_new
+        AFTER UPDATE OF permanence_end_date ON clients
+        WHEN NEW.permanence_end_date IS NOT NULL AND NEW.permanence_end_date != ''
+         AND COALESCE(NEW.permanence_end, '') != NEW.permanence_end_date
+        BEGIN
+            UPDATE clients SET permanence_end = NEW.permanence_end_date
+            WHERE id = NEW.id;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS tg_perm_end_sync_old
+        AFTER UPDATE OF permanence_end ON clients
+        WHEN NEW.permanence_end IS NOT NULL AND NEW.permanence_end != ''
+         AND COALESCE(NEW.permanence_end_date, '') != NEW.permanence_end
+        BEGIN
+            UPDATE clients SET permanence_end_date = NEW.permanence_end
+            WHERE id = NEW.id;
+        END;
+    """)
+
+    # ---- Búsqueda full-text (FTS5 sobre clients) ----
+    # Tabla de contenido externo + triggers que la mantienen en sync;
+    # la búsqueda de /clients pasa de escaneo LIKE a índice invertido
+    db.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(
+            full_name, dni, phone,
+            content='clients', content_rowid='id'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS clients_ai AFTER INSERT ON clients BEGIN
+            INSERT INTO clients_fts(rowid, full_name, dni, phone)
+            VALUES (new.id, new.full_name, new.dni, new.phone);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS clients_ad AFTER DELETE ON clients BEGIN
+            INSERT INTO clients_fts(clients_fts, rowid, full_name, dni, phone)
+            VALUES ('delete', old.id, old.full_name, old.dni, old.phone);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS clients_au AFTER UPDATE ON clients BEGIN
+            INSERT INTO clients_fts(clients_fts, rowid, full_name, dni, phone)
+            VALUES ('delete', old.id, old.full_name, old.dni, old.phone);
+            INSERT INTO clients_fts(rowid, full_name, dni, phone)
+            VALUES (new.id, new.full_name, new.dni, new.phone);
+        END;
+    """)
+
+    # Migraciones únicas (gobernadas por user_version): las versiones
+    # siguientes del esquema arrancan sin pagar los escaneos completos
+    schema_version = db.execute("PRAGMA user_version").fetchone()[0]
+
+    if schema_version < 2:
+        # Poblar el índice FTS con los clientes ya existentes. Tiene que ir
+        # ANTES de cualquier UPDATE sobre clients: el trigger clients_au
+        # emite un 'delete' por fila y FTS5 da "database disk image is
+        # malformed" si la fila aún no está indexada.
+        db.execute("INSERT INTO clients_fts(clients_fts) VALUES ('rebuild')")
+
+    if schema_version < 1:
+        db.execute("""
+            UPDATE clients
+            SET permanence_end_date = permanence_end
+            WHERE (permanence_end_date IS NULL OR permanence_end_date = '')
+              AND permanence_end IS NOT NULL AND permanence_end != '';
+        """)
+
+        db.execute("""
+            UPDATE clients
+            SET permanence_end = permanence_end_date
+            WHERE (permanence_end IS NULL OR permanence_end = '')
+              AND permanence_end_date IS NOT NULL AND permanence_end_date != '';
+        """)
+
+    if schema_version < 2:
+        db.execute("PRAGMA user_version = 2")
+
+    if schema_version < 3:
+        # Normalizar a ISO las fechas guardadas en formatos legados
+        # (dd/mm/yyyy, dd-mm-yyyy, o sin ceros a la izquierda): julianday()
+        # sólo entiende ISO, así que esas filas perdían el aviso del listado
+        # y quedaban fuera del rango del calendario. Se parsea una vez aquí
+        # y el resto del código ya sólo ve ISO.
+        def _legacy_to_iso(raw):
+            raw = (raw or "").strip()
+            for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+                try:
+                    return datetime.strptime(raw, fmt).date().isoformat()
+                except ValueError:
+                    continue
+            return None
+
+        for table, col in (
+            ("clients", "permanence_start"),
+            ("clients", "permanence_end"),
+            ("clients", "permanence_start_date"),
+            ("clients", "permanence_end_date"),
+            ("mobile_lines", "permanence_end_date"),
+        ):
+            rows = db.execute(f"""
+                SELECT id, {col} AS raw FROM {table}
+                WHERE {col} IS NOT NULL AND {col} != ''
+                  AND {col} NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+            """).fetchall()
+            fixes = []
+            for r in rows:
+                iso = _legacy_to_iso(r["raw"])
+                if iso is not None:
+                    fixes.append((iso, r["id"]))
+            if fixes:
+                db.executemany(
+                    f"UPDATE {table} SET {col} = ? WHERE id = ?", fixes
+                )
+        db.execute("PRAGMA user_version = 3")
+
+
+    db.commit()
+    _schema_ok = True
+
+
+with app.app_context():
+    init_db()
+
+# =========================
+# Date utils
+# =========================
+
+# Fin de permanencia efectivo y días restantes, calculados en SQL (C) en vez
+# de parsear fechas fila a fila en Python
+_SQL_END_DATE = "COALESCE(NULLIF(permanence_end_date,''), NULLIF(permanence_end,''))"
+_SQL_DAYS_LEFT = (
+    f"CAST(julianday({_SQL_END_DATE}) - julianday(date('now','localtime')) AS INTEGER)"
+)
+
+
+def parse_yyyy_mm_dd(s: str):
+    s = (s or "").strip()
+    # Los tres formatos aceptados tienen 10 caracteres
+    if len(s) != 10:
+        return None
+
+    # Detectar el formato por la forma del string en vez de probar los tres.
+    # El caso ISO (el habitual) usa date.fromisoformat, que es C puro y mucho
+    # más rápido que strptime
+    try:
+        if s[4] == "-" and s[:4].isdigit():
+            return date.fromisoformat(s)
+        fmt = "%d/%m/%Y" if s[2] == "/" else "%d-%m-%Y"
+        return datetime.strptime(s, fmt).date()
+    except ValueError:
+        return None
+
+
+def add_months(d: date, months: int) -> date:
+    y = d.year + (d.month - 1 + months) // 12
+    m = (d.month - 1 + months) % 12 + 1
+    day = d.day
+
+    if m == 12:
+        next_month = date(y + 1, 1, 1)
+    else:
+        next_month = date(y, m + 1, 1)
+
+    last_day = (next_month - timedelta(days=1)).day
+    if day > last_day:
+        day = last_day
+    return date(y, m, day)
+
+
+def compute_permanence_end(start_str: str, months_str: str, end_str: str):
+    start = parse_yyyy_mm_dd(start_str)
+    end = parse_yyyy_mm_dd(end_str)
+
+    months_int = None
+    ms = (months_str or "").strip()
+    if ms:
+        try:
+            months_int = int(ms)
+        except ValueError:
+            months_int = None
+
+    if end is None and start is not None and months_int is not None:
+        end = add_months(start, months_int)
+
+    start_iso = start.isoformat() if start else None
+    end_iso = end.isoformat() if end else None
+    return start_iso, months_int, end_iso
+
+
+def get_end_date_from_client_row(c):
+    if not c:
+        return None
+
+    keys = c.keys()
+    end_iso = None
+
+    if "permanence_end_date" in keys:
+        end_iso = c["permanence_end_date"]
+
+    if (not end_iso) and ("permanence_end" in keys):
+        end_iso = c["permanence_end"]
+
+    return (end_iso or "").strip() or None
+
+
+def days_until(end_iso: str, today: date = None):
+    d = parse_yyyy_mm_dd(end_iso)
+    if not d:
+        return None
+    if today is None:
+        today = date.today()
+    return (d - today).days
+
+# =========================
+# SQL constante (el texto estable aprovecha la cache de statements)
+# =========================
+_SQL_INSERT_CLIENT = """
+    INSERT INTO clients (
+        full_name, dni, birth_date, phone, address, email,
+        current_operator, current_tariff_price,
+        permanence,
+        permanence_start, permanence_end,
+        permanence_start_date, permanence_months, permanence_end_date,
+        terminal, sales_done, repairs_done, procedures_done, observations,
+        pending_tasks, commercial, created_at
+    ) VALUES (
+        :full_name, :dni, :birth_date, :phone, :address, :email,
+        :current_operator, :current_tariff_price,
+        :permanence,
+        :permanence_start, :permanence_end,
+        :permanence_start_date, :permanence_months, :permanence_end_date,
+        :terminal, :sales_done, :repairs_done, :procedures_done, :observations,
+        :pending_tasks, :commercial, :created_at
+    )
+"""
+
+_SQL_UPDATE_CLIENT = """
+    UPDATE clients SET
+        full_name = :full_name,
+        dni = :dni,
+        birth_date = :birth_date,
+        phone = :phone,
+        address = :address,
+        email = :email,
+        current_operator = :current_operator,
+        current_tariff_price = :current_tariff_price,
+        permanence = :permanence,
+
+        permanence_start = :permanence_start,
+        permanence_end = :permanence_end,
+
+        permanence_start_date = :permanence_start_date,
+        permanence_months = :permanence_months,
+        permanence_end_date = :permanence_end_date,
+
+        terminal = :terminal,
+        sales_done = :sales_done,
+        repairs_done = :repairs_done,
+        procedures_done = :procedures_done,
+        observations = :observations,
+        pending_tasks = :pending_tasks,
+        commercial = :commercial
+    WHERE id = :id
+"""
+
+
+def _client_form_params(form):
+    """Campos del formulario de cliente como dict para binding por nombre."""
+    p_start, p_months, p_end = compute_permanence_end(
+        form.get("permanence_start_date") or form.get("permanence_start"),
+        form.get("permanence_months"),
+        form.get("permanence_end_date") or form.get("permanence_end"),
+    )
+
+    return {
+        "full_name": form["full_name"],
+        "dni": form["dni"],
+        "birth_date": form.get("birth_date"),
+        "phone": form.get("phone"),
+        "address": form.get("address"),
+        "email": form.get("email"),
+        "current_operator": form.get("current_operator"),
+        "current_tariff_price": form.get("current_tariff_price"),
+        "permanence": form.get("permanence"),
+        "permanence_start": p_start,
+        "permanence_end": p_end,
+        "permanence_start_date": p_start,
+        "permanence_months": p_months,
+        "permanence_end_date": p_end,
+        "terminal": form.get("terminal"),
+        "sales_done": form.get("sales_done"),
+        "repairs_done": form.get("repairs_done"),
+        "procedures_done": form.get("procedures_done"),
+        "observations": form.get("observations"),
+        "pending_tasks": form.get("pending_tasks"),
+        "commercial": form.get("commercial"),
+    }
+
+_SQL_INSERT_LINE = """
+    INSERT INTO mobile_lines (
+        client_id, line_number, pin, puk, icc,
+        google_or_iphone_account, permanence_end_date, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_REPAIR = """
+    INSERT INTO repairs (client_id, date, model, repair, cost, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_SALE = """
+    INSERT INTO sales (client_id, date, item, operator, amount, notes, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Cliente + hijos agregados como JSON en una sola consulta (ver view_client)
+_SQL_SELECT_CLIENT_FULL = """
+    SELECT c.*,
+        (SELECT json_group_array(json_object(
+            'id', id, 'line_number', line_number, 'pin', pin, 'puk', puk,
+            'icc', icc, 'google_or_iphone_account', google_or_iphone_account,
+            'permanence_end_date', permanence_end_date))
+         FROM (SELECT * FROM mobile_lines WHERE client_id = c.id ORDER BY id DESC)
+        ) AS lines_json,
+        (SELECT json_group_array(json_object(
+            'id', id, 'date', date, 'model', model, 'repair', repair, 'cost', cost))
+         FROM (SELECT * FROM repairs WHERE client_id = c.id ORDER BY id DESC)
+        ) AS repairs_json,
+        (SELECT json_group_array(json_object(
+            'id', id, 'date', date, 'item', item, 'operator', operator,
+            'amount', amount, 'notes', notes))
+         FROM (SELECT * FROM sales WHERE client_id = c.id ORDER BY id DESC)
+        ) AS sales_json
+    FROM clients c WHERE c.id = ?
+"""
+
+_SQL_SELECT_LINES = """
+    SELECT id, line_number, pin, puk, icc,
+           google_or_iphone_account, permanence_end_date
+    FROM mobile_lines WHERE client_id = ?
+"""
+
+_SQL_UPDATE_LINE = """
+    UPDATE mobile_lines SET
+        pin = ?, puk = ?, google_or_iphone_account = ?,
+        permanence_end_date = ?
+    WHERE id = ?
+"""
+
+# =========================
+# Auth
+# =========================
+def login_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not session.get("user"):
+            return redirect(url_for("login"))
+        return view(*args, **kwargs)
+    return wrapped
+
+
+# La whitelist es fija por proceso: cachear el resultado por email
+@lru_cache(maxsize=256)
+def is_allowed(email):
+    if not ALLOWED_EMAILS:
+        return True
+    return (email or "").casefold() in ALLOWED_EMAILS
+
+# Versión por fichero (mtime) para las URLs de estáticos: permite el año
+# de cache con immutable sin que un logo.jpg reemplazado se quede un año
+# servido de la cache del navegador. El lru_cache evita el stat() por
+# petición; un despliegue reinicia el proceso y refresca la versión.
+@lru_cache(maxsize=None)
+def _static_file_version(filename):
+    try:
+        return int(os.stat(os.path.join(app.static_folder, filename)).st_mtime)
+    except OSError:
+        return 0
+
+
+@app.url_defaults
+def _version_static_urls(endpoint, values):
+    if endpoint == "static" and "filename" in values:
+        values.setdefault("v", _static_file_version(values["filename"]))
+
+
+@app.after_request
+def cache_static_assets(response):
+    # Los estáticos (logo, etc.) llevan ?v=mtime en la URL, así que cada
+    # versión es inmutable: cachear un año en el navegador. Sólo los 200:
+    # un 404 cacheado un año dejaría el asset "perdido" aunque aparezca.
+    # En producción lo ideal sigue siendo servirlos desde nginx.
+    if request.path.startswith("/static/") and response.status_code == 200:
+        # El handler de estáticos de Flask emite no-cache por defecto y
+        # anularía el max-age: quitarlo antes de añadir las directivas
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+
+# =========================
+# Routes
+# =========================
+@app.route("/")
+def home():
+    if session.get("user"):
+        return redirect(url_for("clients"))
+    return redirect(url_for("login"))
+
+
+@app.route("/login")
+def login():
+    return render_template("login.html")
+
+
+@app.route("/auth/google")
+def auth_google():
+    remember = request.args.get("remember") == "1"
+    session["remember_me"] = remember
+    redirect_uri = url_for("auth_google_callback", _external=True)
+    return google.authorize_redirect(redirect_uri)
+
+
+@app.route("/auth/google/callback")
+def auth_google_callback():
+    google.authorize_access_token()
+    userinfo = google.get("userinfo").json()
+
+    email = userinfo.get("email")
+    if not is_allowed(email):
+        session.clear()
+        flash("Cuenta no autorizada", "danger")
+        return redirect(url_for("login"))
+
+    session["user"] = {"email": email, "name": userinfo.get("name") or email}
+
+    if session.get("remember_me"):
+        session.permanent = True
+        app.permanent_session_lifetime = timedelta(days=30)
+
+    session.pop("remember_me", None)
+    return redirect(url_for("clients"))
+
+
+@app.route("/logout")
+def logout():
+    session.clear()
+    return redirect(url_for("login"))
+
+
+def _fts_prefix_query(q: str) -> str:
+    # Cada término entre comillas (inmune a la sintaxis de MATCH) y con
+    # * final para buscar por prefijo
+    return " ".join('"{}"*'.format(t.replace('"', '""')) for t in q.split())
+
+
+@app.route("/clients")
+@login_required
+def clients():
+    db = get_db()
+    q = request.args.get("q", "").strip()
+
+    try:
+        page = max(int(request.args.get("page", "1")), 1)
+    except ValueError:
+        page = 1
+    per = 50
+
+    # Con mensajes flash pendientes no se toca la cache: la página cacheada
+    # no los pintaría (quedarían colgados en la sesión) y guardarla los
+    # dejaría horneados en el HTML que verían otros usuarios
+    cache_key = None
+    if cache is not None and not session.get("_flashes"):
+        cache_key = f"clients:list:{_clients_cache_ver()}:{page}:{q}"
+        html = cache.get(cache_key)
+        if html is not None:
+            return html
+
+    # Sólo las columnas que pinta la lista, paginadas (se pide una fila extra
+    # para saber si hay página siguiente). El bucket de aviso también se
+    # clasifica en SQL para que la plantilla no encadene condicionales
+    select = (
+        "SELECT c.id, c.full_name, c.dni, c.phone, c.current_operator, c.permanence, "
+        f"{_SQL_DAYS_LEFT} AS days_left, "
+        f"CASE WHEN {_SQL_DAYS_LEFT} IS NULL THEN 'none' "
+        f"     WHEN {_SQL_DAYS_LEFT} < 0 THEN 'expired' "
+        f"     WHEN {_SQL_DAYS_LEFT} <= ? THEN 'soon' "
+        "      ELSE 'ok' END AS alert_bucket "
+    )
+
+    if q:
+        # Búsqueda por índice invertido FTS5 (prefijos por término) en vez de
+        # LIKE '%q%' con escaneo completo
+        rows = db.execute(
+            f"""
+            {select}
+            FROM clients c JOIN clients_fts f ON c.id = f.rowid
+            WHERE clients_fts MATCH ?
+            ORDER BY c.id DESC
+            LIMIT ? OFFSET ?
+            """,
+            (ALERT_DAYS, _fts_prefix_query(q), per + 1, (page - 1) * per)
+        ).fetchall()
+    else:
+        rows = db.execute(
+            f"{select} FROM clients c ORDER BY c.id DESC LIMIT ? OFFSET ?",
+            (ALERT_DAYS, per + 1, (page - 1) * per)
+        ).fetchall()
+
+    has_next = len(rows) > per
+    rows = rows[:per]
+
+    html = render_template(
+        "clients_list.html",
+        clients=rows,
+        q=q,
+        alert_days=ALERT_DAYS,
+        page=page,
+        has_next=has_next
+    )
+
+    if cache_key is not None:
+        cache.set(cache_key, html, timeout=300)
+
+    return html
+
+
+@app.route("/calendar", endpoint="calendar_view")
+@login_required
+def calendar_view():
+    days = request.args.get("days", "365").strip()
+    try:
+        days_int = int(days)
+    except ValueError:
+        days_int = 365
+
+    # Rango sargable sobre la fecha de fin: SQLite filtra por comparación de
+    # strings ISO en vez de evaluar julianday() para cada fila
+    db = get_db()
+    rows = db.execute(
+        f"""
+        SELECT id, full_name, dni, phone,
+               {_SQL_END_DATE} AS end_date, {_SQL_DAYS_LEFT} AS days_left
+        FROM clients
+        WHERE {_SQL_END_DATE} BETWEEN date('now', 'localtime')
+                                  AND date('now', 'localtime', ? || ' days')
+        ORDER BY end_date
+        """,
+        (f"+{days_int}",)
+    ).fetchall()
+
+    upcoming = [(r, r["days_left"]) for r in rows]
+
+    return render_template("calendar.html", upcoming=upcoming, days=days_int, alert_days=ALERT_DAYS)
+
+
+@app.route("/api/permanencias", endpoint="api_permanencias")
+@login_required
+def api_permanencias():
+    # Cursor con tuplas planas: el bucle caliente se ahorra la búsqueda por
+    # nombre de columna de sqlite3.Row en cada celda
+    db = get_db()
+    cur = db.cursor()
+    cur.row_factory = None
+    rows = cur.execute(
+        f"""
+        SELECT id, full_name, phone, email, current_operator,
+               {_SQL_END_DATE} AS end_date,
+               {_SQL_DAYS_LEFT} AS days_left
+        FROM clients
+        WHERE {_SQL_END_DATE} IS NOT NULL
+        ORDER BY end_date
+        """
+    ).fetchall()
+
+    # url_for hace lookup de rutas + quoting en cada llamada: una sola vez
+    # y se concatena el id por fila
+    url_prefix = url_for("view_client", client_id=0).rsplit("/", 1)[0] + "/"
+
+    out = [{
+        "id": cid,
+        "full_name": full_name,
+        "phone": phone,
+        "email": email,
+        "current_operator": operator,
+        "permanence_end_date": end_date,
+        "days_left": days_left,
+        "url": url_prefix + str(cid)
+    } for cid, full_name, phone, email, operator, end_date, days_left in rows]
+
+    if orjson is not None:
+        payload = orjson.dumps(out)
+    else:
+        payload = json.dumps(out, separators=(",", ":")).encode()
+
+    # ETag sobre el payload + max-age corto: el poll del calendario recibe
+    # 304 sin cuerpo cuando nada ha cambiado
+    resp = Response(payload, mimetype="application/json")
+    resp.add_etag()
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 30
+    return resp.make_conditional(request)
+
+
+@app.route("/clients/new", methods=["GET", "POST"])
+@login_required
+def new_client():
+    if request.method == "POST":
+        db = get_db()
+
+        params = _client_form_params(request.form)
+        params["created_at"] = datetime.utcnow().isoformat()
+
+        cur = db.execute(_SQL_INSERT_CLIENT, params)
+        client_id = cur.lastrowid
+        db.commit()
+        _bump_clients_cache()
+        return redirect(url_for("view_client", client_id=client_id))
+
+    return render_template("client_form.html", client=None, lines=[], repairs=[], sales=[], alert_days=ALERT_DAYS)
+
+
+@app.route("/clients/<int:client_id>")
+@login_required
+def view_client(client_id):
+    db = get_db()
+
+    # Cliente + líneas + reparaciones + ventas en una sola ida a SQLite:
+    # los hijos vuelven como arrays JSON agregados en C
+    client = db.execute(_SQL_SELECT_CLIENT_FULL, (client_id,)).fetchone()
+
+    if client is None:
+        flash("Cliente no encontrado", "danger")
+        return redirect(url_for("clients"))
+
+    lines = json.loads(client["lines_json"])
+    repairs = json.loads(client["repairs_json"])
+    sales = json.loads(client["sales_json"])
+
+    end_iso = get_end_date_from_client_row(client)
+    du = days_until(end_iso) if end_iso else None
+
+    return render_template(
+        "client_form.html",
+        client=client,
+        lines=lines,
+        repairs=repairs,
+        sales=sales,
+        alert_days=ALERT_DAYS,
+        days_left=du
+    )
+
+
+@app.route("/clients/<int:client_id>/update", methods=["POST"])
+@login_required
+def update_client(client_id):
+    db = get_db()
+
+    # Un solo acceso al MultiDict de werkzeug; 'get' ligado para el bucle
+    form = request.form
+    get = form.get
+
+    params = _client_form_params(form)
+    params["id"] = client_id
+
+    # -------------------------
+    # Guardar líneas móviles
+    # -------------------------
+    now_iso = datetime.utcnow().isoformat()
+
+    # Sólo los índices de fila presentes de verdad en el formulario (las
+    # tarjetas quitadas en el cliente no llegan), sin barrer 0..line_count
+    indices = sorted(
+        int(k.rsplit("_", 1)[1])
+        for k in form
+        if k.startswith("line_number_") and k.rsplit("_", 1)[1].isdigit()
+    )
+
+    posted = []
+    for i in indices:
+        line_number = (get(f"line_number_{i}") or "").strip()
+        pin = (get(f"pin_{i}") or "").strip()
+        puk = (get(f"puk_{i}") or "").strip()
+        icc = (get(f"icc_{i}") or "").strip()
+        account = (get(f"account_{i}") or "").strip()
+
+        # Nuevo: fin permanencia por línea
+        line_perm_end = (get(f"line_perm_end_{i}") or "").strip()
+
+        # Si no hay nada, saltamos
+        if not (line_number or pin or puk or icc or account or line_perm_end):
+            continue
+
+        posted.append((line_number, pin, puk, icc, account, line_perm_end))
+
+    # Diff contra las líneas actuales (identidad: número + ICC) para emitir
+    # sólo el DML mínimo en vez de borrar y reinsertar todo
+    existing = {}
+    for r in db.execute(_SQL_SELECT_LINES, (client_id,)).fetchall():
+        key = (r["line_number"] or "", r["icc"] or "")
+        existing.setdefault(key, []).append(r)
+
+    line_inserts, line_updates = [], []
+    for line_number, pin, puk, icc, account, line_perm_end in posted:
+        bucket = existing.get((line_number, icc))
+        if bucket:
+            r = bucket.pop(0)
+            changed = (
+                pin != (r["pin"] or "")
+                or puk != (r["puk"] or "")
+                or account != (r["google_or_iphone_account"] or "")
+                or line_perm_end != (r["permanence_end_date"] or "")
+            )
+            if changed:
+                line_updates.append((pin, puk, account, line_perm_end, r["id"]))
+        else:
+            line_inserts.append((
+                client_id, line_number, pin, puk, icc,
+                account, line_perm_end, now_iso
+            ))
+
+    line_deletes = [(r["id"],) for bucket in existing.values() for r in bucket]
+
+    # Una sola transacción (y un solo fsync) para el UPDATE + diff de líneas
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute(_SQL_UPDATE_CLIENT, params)
+
+        if line_deletes:
+            db.executemany("DELETE FROM mobile_lines WHERE id = ?", line_deletes)
+
+        if line_updates:
+            db.executemany(_SQL_UPDATE_LINE, line_updates)
+
+        if line_inserts:
+            db.executemany(_SQL_INSERT_LINE, line_inserts)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    _bump_clients_cache()
+    flash("Cliente actualizado", "success")
+    return redirect(url_for("view_client", client_id=client_id))
+
+
+@app.route("/clients/<int:client_id>/repairs/add", methods=["POST"])
+@login_required
+def add_repair(client_id):
+    db = get_db()
+
+    date_ = request.form.get("repair_date")
+    model = request.form.get("repair_model")
+    repair = request.form.get("repair_text")
+
+    cost = _parse_money(request.form.get("repair_cost"))
+
+    db.execute(_SQL_INSERT_REPAIR, (
+        client_id,
+        date_,
+        model,
+        repair,
+        cost,
+        datetime.utcnow().isoformat()
+    ))
+    db.commit()
+    return redirect(url_for("view_client", client_id=client_id))
+
+
+_MONEY_RE = re.compile(r"^-?\d+(?:[.,]\d+)?$")
+
+
+def _parse_money(raw):
+    # Valida con regex precompilada; sólo sustituye la coma si la hay
+    s = (raw or "").strip()
+    if not s or not _MONEY_RE.match(s):
+        return None
+    return float(s.replace(",", ".", 1) if "," in s else s)
+
+
+def _json_number(v):
+    # Acepta números JSON o strings tipo "39,90"
+    if isinstance(v, (int, float)):
+        return float(v)
+    if v is None:
+        return None
+    return _parse_money(str(v))
+
+
+@app.route("/clients/<int:client_id>/repairs/bulk", methods=["POST"])
+@login_required
+def add_repairs_bulk(client_id):
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "se esperaba una lista JSON"}), 400
+    if not all(isinstance(it, dict) for it in items):
+        return jsonify({"error": "cada elemento debe ser un objeto JSON"}), 400
+
+    now_iso = datetime.utcnow().isoformat()
+    rows = [(
+        client_id,
+        it.get("date"),
+        it.get("model"),
+        it.get("repair"),
+        _json_number(it.get("cost")),
+        now_iso
+    ) for it in items]
+
+    db = get_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany(_SQL_INSERT_REPAIR, rows)
+        db.commit()
+    except sqlite3.ProgrammingError:
+        # Valores no escalares (objetos/listas anidados) en los campos:
+        # error del cliente, no del servidor
+        db.rollback()
+        return jsonify({"error": "los campos deben ser valores escalares"}), 400
+    except Exception:
+        db.rollback()
+        raise
+
+    return jsonify({"inserted": len(rows)})
+
+
+@app.route("/clients/<int:client_id>/repairs/<int:repair_id>/delete", methods=["POST"])
+@login_required
+def delete_repair(client_id, repair_id):
+    db = get_db()
+    # RETURNING: detecta "no existe / no es de este cliente" sin otro SELECT
+    deleted = db.execute(
+        "DELETE FROM repairs WHERE id = ? AND client_id = ? RETURNING id",
+        (repair_id, client_id)
+    ).fetchone()
+    db.commit()
+
+    if deleted is None:
+        flash("Reparación no encontrada", "warning")
+    return redirect(url_for("view_client", client_id=client_id))
+
+
+@app.route("/clients/<int:client_id>/sales/add", methods=["POST"])
+@login_required
+def add_sale(client_id):
+    db = get_db()
+
+    date_ = request.form.get("sale_date")
+    item = request.form.get("sale_item")
+    operator = request.form.get("sale_operator")
+
+    amount = _parse_money(request.form.get("sale_amount"))
+
+    notes = request.form.get("sale_notes")
+
+    db.execute(_SQL_INSERT_SALE, (
+        client_id,
+        date_,
+        item,
+        operator,
+        amount,
+        notes,
+        datetime.utcnow().isoformat()
+    ))
+    db.commit()
+    return redirect(url_for("view_client", client_id=client_id))
+
+
+@app.route("/clients/<int:client_id>/sales/bulk", methods=["POST"])
+@login_required
+def add_sales_bulk(client_id):
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return jsonify({"error": "se esperaba una lista JSON"}), 400
+    if not all(isinstance(it, dict) for it in items):
+        return jsonify({"error": "cada elemento debe ser un objeto JSON"}), 400
+
+    now_iso = datetime.utcnow().isoformat()
+    rows = [(
+        client_id,
+        it.get("date"),
+        it.get("item"),
+        it.get("operator"),
+        _json_number(it.get("amount")),
+        it.get("notes"),
+        now_iso
+    ) for it in items]
+
+    db = get_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany(_SQL_INSERT_SALE, rows)
+        db.commit()
+    except sqlite3.ProgrammingError:
+        db.rollback()
+        return jsonify({"error": "los campos deben ser valores escalares"}), 400
+    except Exception:
+        db.rollback()
+        raise
+
+    return jsonify({"inserted": len(rows)})
+
+
+@app.route("/clients/<int:client_id>/sales/<int:sale_id>/delete", methods=["POST"])
+@login_required
+def delete_sale(client_id, sale_id):
+    db = get_db()
+    deleted = db.execute(
+        "DELETE FROM sales WHERE id = ? AND client_id = ? RETURNING id",
+        (sale_id, client_id)
+    ).fetchone()
+    db.commit()
+
+    if deleted is None:
+        flash("Venta no encontrada", "warning")
+    return redirect(url_for("view_client", client_id=client_id))
+
+
+@app.route("/clients/<int:client_id>/delete", methods=["POST"])
+@login_required
+def delete_client(client_id):
+    db = get_db()
+    deleted = db.execute(
+        "DELETE FROM clients WHERE id = ? RETURNING id", (client_id,)
+    ).fetchone()
+    db.commit()
+
+    if deleted is None:
+        flash("Cliente no encontrado", "warning")
+        return redirect(url_for("clients"))
+
+    _bump_clients_cache()
+    flash("Cliente eliminado", "success")
+    return redirect(url_for("clients"))
+
+
+if __name__ == "__main__":
+    # Sólo para desarrollo. En producción, workers con hilos para solapar
+    # las esperas de I/O de SQLite (las lecturas son concurrentes bajo WAL):
+    #   gunicorn -k gthread -w 4 --threads 8 app:app
+    app.run(debug=os.environ.get("FLASK_ENV") == "development")